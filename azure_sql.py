@@ -1,10 +1,71 @@
+import datetime
+import decimal
 import logging
+import threading
+import time
 import traceback
 import pyodbc
 import struct
 from azure.identity import DefaultAzureCredential
 import pandas as pd
+import pyarrow as pa
 
+# Rows fetched per round of cursor.fetchmany() in read_sql
+DEFAULT_CHUNKSIZE = 128 * 1024
+
+# Shared credential and access-token cache; building the credential chain and
+# fetching a token are slow, and a token stays valid for about an hour.
+_credential = DefaultAzureCredential()
+_token_cache = {}
+_token_lock = threading.Lock()
+# Refresh tokens this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 300
+
+def _get_token(scope="https://database.windows.net/.default"):
+    with _token_lock:
+        token = _token_cache.get(scope)
+        if token is None or token.expires_on - time.time() <= TOKEN_REFRESH_MARGIN:
+            token = _credential.get_token(scope)
+            _token_cache[scope] = token
+        return token.token
+
+# Column dtypes for pyodbc type codes (cursor.description[i][1]) that map onto
+# a fixed-width numpy type
+# Arrow types for pyodbc type codes; decimals take precision/scale from the description
+_ARROW_TYPES = {
+    int: pa.int64(),
+    float: pa.float64(),
+    bool: pa.bool_(),
+    str: pa.string(),
+    bytes: pa.binary(),
+    bytearray: pa.binary(),
+    datetime.datetime: pa.timestamp("us"),
+    datetime.date: pa.date32(),
+    datetime.time: pa.time64("us"),
+}
+
+def _arrow_type(description):
+    type_code, precision, scale = description[1], description[4], description[5]
+    if type_code is decimal.Decimal:
+        return pa.decimal128(precision, scale)
+    return _ARROW_TYPES.get(type_code)
+
+def _arrow_frame_from_rows(rows, description):
+    """
+    Builds an Arrow-backed DataFrame from fetched pyodbc rows. Each column is
+    converted to an Arrow array of the type in cursor.description, so empty and
+    all-NULL columns keep their type, and handed to pandas without going
+    through the block manager's consolidation copy.
+    """
+    columns = [desc[0] for desc in description]
+    data = zip(*rows) if rows else [()] * len(columns)
+    arrays = [pa.array(values, type=_arrow_type(desc)) for values, desc in zip(data, description)]
+    table = pa.Table.from_arrays(arrays, names=columns)
+    return table.to_pandas(types_mapper=pd.ArrowDtype, self_destruct=True)
+
+def _split_batches(script):
+    """Splits a T-SQL script into batches on GO separator lines."""
+    return [batch.strip() for batch in script.split("\nGO\n") if batch.strip()]
 
 class DatabaseConnectionError(Exception):
     """Custom exception for database connection errors."""
@@ -12,19 +73,50 @@ class DatabaseConnectionError(Exception):
 
 class DatabaseConnection:
     """
-    Singleton class to manage a single database connection.
+    Manages the connections to one database.
+    Constructing it again with the same server, database, driver and localRun
+    returns the existing instance. pyodbc connections must not be shared
+    between threads, so each thread opens its own connection on first use.
+    Streamlit runs every rerun on a new thread, so these connections are not
+    reused across reruns; reopening them is cheap because pyodbc's default
+    ODBC driver-manager pooling hands back an already-open connection.
     """
-    _instance = None
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __new__(cls, server, database, driver, localRun):
+        key = (server, database, driver, localRun)
+        with cls._instances_lock:
+            instance = cls._instances.get(key)
+            if instance is None:
+                instance = super().__new__(cls)
+                instance._local = threading.local()
+                cls._instances[key] = instance
+        return instance
   
     def __init__(self, server, database, driver,localRun):
         """
-        Private constructor to prevent direct object creation.
+        Connects on first construction; later constructions reuse the instance.
         """
-        if not hasattr(self, '_initialized'):  # Prevent re-initialization
+        if not getattr(self, '_initialized', False):  # Prevent re-initialization
             self._initialized = True
+            self._connect_args = (server, database, driver, localRun)
             self._connection = None
             self._setup_connection(server, database, driver,localRun)
 
+    @property
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None and getattr(self, '_initialized', False):
+            # First use from this thread
+            self._setup_connection(*self._connect_args)
+            connection = self._local.connection
+        return connection
+
+    @_connection.setter
+    def _connection(self, connection):
+        self._local.connection = connection
+
     
     def _setup_connection(self, server, database, driver,localRun):
         """
@@ -42,18 +134,15 @@ class DatabaseConnection:
         connection_string = f'DRIVER={driver};SERVER={server};DATABASE={database}'
         try:
             # SQL Authentication Through MI As MSI_SECRET
-            credential = DefaultAzureCredential()
-            token = credential.get_token("https://database.windows.net/").token
             if localRun != 'LOCAL':
                 logging.info('Connection Using Authentication=ActiveDirectoryMsi')
                 self._connection = pyodbc.connect(connection_string+';Authentication=ActiveDirectoryMsi')
             else:
                 logging.info('Connection Using SQL_COPT_SS_ACCESS_Token')
+                token = _get_token()
                 SQL_COPT_SS_ACCESS_TOKEN = 1256
-                exptoken = b''
-                for i in bytes(token, "UTF-8"):
-                    exptoken += bytes({i})
-                    exptoken += bytes(1)
+                # The driver expects the token as UCS-2; for the ASCII token this is <byte, 0x00> per char
+                exptoken = token.encode("utf-16-le")
                 tokenstruct = struct.pack("=i", len(exptoken)) + exptoken
                 self._connection = pyodbc.connect(connection_string, attrs_before = { SQL_COPT_SS_ACCESS_TOKEN:tokenstruct })
         except Exception as err:
@@ -84,8 +173,10 @@ class DatabaseConnection:
                 param_placeholders = ""
                 param_values = []
 
-            # Combine SP exec + select from temp table in one batch
+            # Combine SP exec + select from temp table in one batch;
+            # NOCOUNT drops the row-count messages between result sets
             sql_query = f"""
+            SET NOCOUNT ON;
             EXEC {procedure_name} {param_placeholders};
             SELECT * FROM {temp_table_name};
             """
@@ -93,20 +184,17 @@ class DatabaseConnection:
             cursor.execute(sql_query, param_values)
 
             # Skip results until you get to the final SELECT results
+            last_result = None
             while True:
-                try:
-                    columns = [desc[0] for desc in cursor.description]
-                    rows = cursor.fetchall()
-                    df = pd.DataFrame.from_records(rows, columns=columns)
-                    return df
-                except Exception:
-                    pass
+                if cursor.description is not None:
+                    last_result = (cursor.fetchall(), cursor.description)
                 if not cursor.nextset():
                     break
 
-            # If no resultset found
-            logging.warning("No results returned from combined SP and select.")
-            return pd.DataFrame()
+            if last_result is None:
+                logging.warning("No results returned from combined SP and select.")
+                return pd.DataFrame()
+            return _arrow_frame_from_rows(*last_result)
 
         except Exception as e:
             logging.error(f"Error calling stored procedure with select: {e}")
@@ -121,7 +209,7 @@ class DatabaseConnection:
         if not self._connection:
             raise DatabaseConnectionError("Database connection not established")
 
-        batches = [batch.strip() for batch in script.split("\nGO\n") if batch.strip()]
+        batches = _split_batches(script)
 
         cursor = self._connection.cursor()
         try:
@@ -140,24 +228,87 @@ class DatabaseConnection:
             while cursor.description is None and cursor.nextset():
                 pass
 
-            columns = [col[0] for col in cursor.description]
             rows = cursor.fetchall()
-            return pd.DataFrame.from_records(rows, columns=columns)
+            return _arrow_frame_from_rows(rows, cursor.description)
 
         finally:
             cursor.close()
 
     
-    def read_sql(self,query):
+    def read_sql(self, query, params=None, chunksize=DEFAULT_CHUNKSIZE, as_iterator=False, input_sizes=None):
+        """
+        Executes a query and returns its result set as a DataFrame.
+        Rows are pulled from the cursor chunksize at a time so only one chunk
+        of raw rows is alive at once. With as_iterator=True a generator of
+        DataFrame chunks is returned instead of a single concatenated frame.
+        Params bind to ? placeholders; input_sizes, if given, is passed to
+        cursor.setinputsizes() so parameter types are not re-negotiated per call.
+        """
         if not self._connection:
             raise DatabaseConnectionError("Database connection not established")
+        chunks = self._iter_sql_chunks(query, params, chunksize, input_sizes)
+        if as_iterator:
+            return chunks
         try:
-            df = pd.read_sql(query, self._connection)
+            frames = list(chunks)
+        except DatabaseConnectionError:
+            raise
         except Exception as err:
             raise DatabaseConnectionError(f"Error executing query: {err}") from err
-        return df
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames, ignore_index=True, copy=False)
+
+    def _iter_sql_chunks(self, query, params, chunksize, input_sizes):
+        cursor = self._connection.cursor()
+        try:
+            cursor.arraysize = chunksize
+            try:
+                if input_sizes:
+                    cursor.setinputsizes(input_sizes)
+                cursor.execute(query, params or [])
+            except Exception as err:
+                raise DatabaseConnectionError(f"Error executing query: {err}") from err
+            description = cursor.description
+            yielded = False
+            for rows in iter(lambda: cursor.fetchmany(chunksize), []):
+                yielded = True
+                yield _arrow_frame_from_rows(rows, description)
+            if not yielded:
+                yield _arrow_frame_from_rows([], description)
+        finally:
+            cursor.close()
     
-    def execute_query(self, query, params=None):
+    def read_sql_result_sets(self, query, params=None, input_sizes=None):
+        """
+        Executes a batch that returns several result sets and returns one
+        DataFrame per SELECT, in order, so related queries share a single
+        round-trip. Row counts from DML statements are skipped.
+        """
+        if not self._connection:
+            raise DatabaseConnectionError("Database connection not established")
+
+        cursor = None
+        frames = []
+        try:
+            cursor = self._connection.cursor()
+            if input_sizes:
+                cursor.setinputsizes(input_sizes)
+            cursor.execute(query, params or [])
+            while True:
+                if cursor.description is not None:
+                    rows = cursor.fetchall()
+                    frames.append(_arrow_frame_from_rows(rows, cursor.description))
+                if not cursor.nextset():
+                    break
+        except Exception as err:
+            raise DatabaseConnectionError(f"Error executing query: {err}") from err
+        finally:
+            if cursor:
+                cursor.close()
+        return frames
+
+    def execute_query(self, query, params=None, input_sizes=None):
         if not self._connection:
             raise DatabaseConnectionError("Database connection not established")
 
@@ -165,6 +316,8 @@ class DatabaseConnection:
         rows = None
         try:
             cursor = self._connection.cursor()
+            if input_sizes:
+                cursor.setinputsizes(input_sizes)
             cursor.execute(query, params or [])
             # Fetch the Query result into a variable
             rows = cursor.fetchall()
@@ -175,20 +328,53 @@ class DatabaseConnection:
                 cursor.close()
         return rows
     
+    def execute_many(self, query, seq_of_params, input_sizes=None):
+        """
+        Runs a parameterized write for every parameter row in one bulk
+        round-trip using pyodbc's fast_executemany, then commits.
+        input_sizes, if given, is passed to cursor.setinputsizes() so the driver
+        does not have to describe the parameters itself (which fails for
+        local #temp tables).
+        """
+        if not self._connection:
+            raise DatabaseConnectionError("Database connection not established")
+
+        cursor = None
+        try:
+            cursor = self._connection.cursor()
+            cursor.fast_executemany = True
+            if input_sizes:
+                cursor.setinputsizes(input_sizes)
+            cursor.executemany(query, seq_of_params)
+            self._connection.commit()
+        except Exception as err:
+            raise DatabaseConnectionError(f"Error executing query: {err}") from err
+        finally:
+            if cursor:
+                cursor.close()
+
     def run_multistatement_script(self, script: str):
         if not self._connection:
             raise DatabaseConnectionError("No active DB connection.")
         cursor = self._connection.cursor()
-        for stmt in script.strip().split(';'):
-            if stmt.strip():
-                cursor.execute(stmt)
-        self._connection.commit()
+        try:
+            # SQL Server runs each batch's statements from one call, so only GO
+            # separators cost an extra round-trip
+            for batch in _split_batches(script):
+                cursor.execute(batch)
+                # Step through every statement's result so later errors surface
+                while cursor.nextset():
+                    pass
+            self._connection.commit()
+        finally:
+            cursor.close()
 
     def close_connection(self):
-      if self._connection is not None:
+      # The instance is shared between threads and sessions, so only the calling
+      # thread's connection is closed; it reconnects on its next use.
+      if getattr(self._local, 'connection', None) is not None:
           self._connection.close()
           self._connection = None
-          self._initialized = False
 
     def __enter__(self):
         logging.info("db __enter__")
@@ -1,6 +1,11 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import numpy as np
 import pandas as pd
+import pyodbc
 # --------------------------
 # 1. Initialize DB connections
 # --------------------------
@@ -34,8 +39,19 @@ load_dotenv()  # Load variables from .env
 #     localRun=local_run
 # )
 
+# One DatabaseConnection per database, shared across reruns and sessions; the
+# pyodbc connections under it are per thread and come from the ODBC pool
+@st.cache_resource(show_spinner=False)
+def get_db(server, database, driver, localRun):
+    return DatabaseConnection(
+        server=server,
+        database=database,
+        driver=driver,
+        localRun=localRun
+    )
+
 # Forecast / Site info DB
-integ_db = DatabaseConnection(
+integ_db = get_db(
     server="sql-ago-aiq-prd-use.database.windows.net",
     database="sqldb-integration-management-prd",
     driver="{ODBC Driver 17 for SQL Server}",
@@ -43,7 +59,7 @@ integ_db = DatabaseConnection(
 )
 
 # Order / Purchase DB
-order_db = DatabaseConnection(
+order_db = get_db(
     server="sql-ago-aiq-prd-use.database.windows.net",
     database="sqldb-order-management-prd",
     driver="{ODBC Driver 17 for SQL Server}",
@@ -57,6 +73,206 @@ st.set_page_config(
 )
 st.title("Forecast vs Actual Orders Comparison")
 
+# --------------------------
+# Cached loaders
+# --------------------------
+# Every widget interaction reruns the script; the queries below only depend on
+# the site and the current day, so their results are reused until either changes.
+# Yesterday's forecast is fixed for the day, but today's orders and their
+# statuses keep changing, so those are only reused for a short while.
+ORDERS_CACHE_TTL = 120
+# Values are bound as parameters so SQL Server reuses one plan for every site.
+# The day is bound too, rather than taken from GETDATE() (UTC on Azure SQL), so
+# the rows always belong to the same day as the cache key.
+SITE_NAME_INPUT = [(pyodbc.SQL_WVARCHAR, 50, 0)]
+SITE_ID_INPUT = [(pyodbc.SQL_INTEGER, 0, 0)]
+DAY_INPUT = [(pyodbc.SQL_TYPE_DATE, 0, 0)]
+# Rows shown in each table; the comparison itself always uses the full data
+DISPLAY_ROW_LIMIT = 10_000
+ROW_LIMIT_INPUT = [(pyodbc.SQL_INTEGER, 0, 0)]
+# ODBC parameter types for the SQL Server column types staged in #OrderLines
+SQL_INPUT_TYPES = {
+    "char": pyodbc.SQL_CHAR,
+    "varchar": pyodbc.SQL_VARCHAR,
+    "nchar": pyodbc.SQL_WCHAR,
+    "nvarchar": pyodbc.SQL_WVARCHAR,
+    "decimal": pyodbc.SQL_DECIMAL,
+    "numeric": pyodbc.SQL_NUMERIC,
+    "tinyint": pyodbc.SQL_TINYINT,
+    "smallint": pyodbc.SQL_SMALLINT,
+    "int": pyodbc.SQL_INTEGER,
+    "bigint": pyodbc.SQL_BIGINT,
+    "real": pyodbc.SQL_REAL,
+    "float": pyodbc.SQL_DOUBLE,
+}
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def load_site_codes(site_names):
+    # Site codes rarely change, so every dropdown site is resolved in one query
+    # and later selections are dictionary lookups. Site names start with the
+    # dropdown label; prefix matches can seek on the Name index.
+    name_filters = " OR ".join(["Name LIKE ?"] * len(site_names))
+    site_query = f"""
+    SELECT Name, SiteCode
+    FROM contractDW.DimSite
+    WHERE PracticeCode = 293
+      AND ({name_filters})
+    ORDER BY Name
+    """
+    site_df = integ_db.read_sql(
+        site_query,
+        [f"{site_name}%" for site_name in site_names],
+        input_sizes=SITE_NAME_INPUT * len(site_names)
+    )
+    # LIKE is case-insensitive under the database collation, so match the same way here
+    site_codes = {}
+    for name, site_code in site_df[["Name", "SiteCode"]].itertuples(index=False):
+        for site_name in site_names:
+            if name.casefold().startswith(site_name.casefold()):
+                site_codes.setdefault(site_name, int(site_code))
+    return site_codes
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_forecast(site_id, day):
+    # Only displayed; the comparison joins the full forecast on the server.
+    # One row past the display limit tells whether the table was cut off.
+    forecast_query = """
+    SELECT TOP (?)
+        fd.ProductName,
+        fd.NDC,
+        fd.OrderQty,
+        fd.OrderUOM,
+        fd.ParMin,
+        fd.ParMax,
+        fd.ForecastQty,
+        fd.DispensedQty,
+        fd.PendingTransferQty,
+        fd.PendingOrderedQty,
+        fd.CurrentInventoryQty
+    FROM [iq].[ForecastDetails] fd
+    JOIN [iq].[ForecastHistory] fh
+        ON fd.ForecastId = fh.Id
+    WHERE fh.CreatedDate >= DATEADD(day, -1, ?)
+      AND fh.CreatedDate < ?
+      AND fh.SiteId = ?
+    """
+    return integ_db.read_sql(
+        forecast_query,
+        (DISPLAY_ROW_LIMIT + 1, day, day, site_id),
+        input_sizes=ROW_LIMIT_INPUT + DAY_INPUT * 2 + SITE_ID_INPUT
+    )
+
+@st.cache_data(ttl=ORDERS_CACHE_TTL, show_spinner=False)
+def load_status_and_orders(site_id, day):
+    # Both result sets hang off today's purchase orders for the site, so the ids
+    # are resolved once and the two SELECTs share a single round-trip.
+    # The status check only needs a yes/no, so the server answers it with EXISTS.
+    orders_script = """
+    SET NOCOUNT ON;
+    DECLARE @ids TABLE (id int PRIMARY KEY);
+    INSERT INTO @ids (id)
+    SELECT id
+    FROM dbo.PurchaseOrders
+    WHERE SiteId = ?
+        AND CreatedDate >= ?
+        AND CreatedDate < DATEADD(day, 1, ?);
+
+    SELECT CAST(CASE WHEN EXISTS (
+        SELECT 1
+        FROM dbo.PurchaseOrderDetails pod
+        WHERE IsLatest = 1
+          AND OrderStatusId IN (1, 6)
+          AND PurchaseOrderId IN (SELECT id FROM @ids)
+    ) THEN 1 ELSE 0 END AS bit) AS HasInvalidStatus;
+
+    SELECT pli.NDC, pli.DrugName, pli.Quantity
+    FROM dbo.PoLineItems pli
+    WHERE PurchaseOrderId IN (SELECT id FROM @ids);
+    """
+    status_df, orders_df = order_db.read_sql_result_sets(
+        orders_script, (site_id, day, day), input_sizes=SITE_ID_INPUT + DAY_INPUT * 2
+    )
+    return bool(status_df.iloc[0]["HasInvalidStatus"]), orders_df
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def load_order_line_types():
+    # Declared types of the PoLineItems columns staged for the comparison, so the
+    # temp table holds every value unchanged (no truncation or rounding). Each
+    # column maps to (DDL type, setinputsizes entry or None if not in SQL_INPUT_TYPES).
+    column_query = """
+    SELECT COLUMN_NAME, DATA_TYPE, CHARACTER_MAXIMUM_LENGTH, NUMERIC_PRECISION, NUMERIC_SCALE
+    FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_SCHEMA = 'dbo'
+      AND TABLE_NAME = 'PoLineItems'
+      AND COLUMN_NAME IN ('NDC', 'Quantity')
+    """
+    column_types = {}
+    for name, data_type, max_length, precision, scale in order_db.execute_query(column_query):
+        sql_type = SQL_INPUT_TYPES.get(data_type)
+        if max_length is not None:
+            ddl_type = f"{data_type}({'max' if max_length == -1 else max_length})"
+            input_size = (sql_type, 0 if max_length == -1 else max_length, 0)
+        elif data_type in ("decimal", "numeric"):
+            ddl_type = f"{data_type}({precision}, {scale})"
+            input_size = (sql_type, precision, scale)
+        else:
+            ddl_type = data_type
+            input_size = (sql_type, 0, 0)
+        column_types[name] = (ddl_type, input_size if sql_type is not None else None)
+    return column_types
+
+@st.cache_data(ttl=ORDERS_CACHE_TTL, show_spinner=False)
+def load_comparison(site_id, day, orders_df):
+    # Forecast and orders live in separate databases, so today's order lines are
+    # staged in a temp table next to the forecast and the join runs on the server.
+    # orders_df is part of the cache key, so the comparison always matches the
+    # orders displayed above it.
+    # NDC takes the integration DB's collation so it compares with ForecastDetails.NDC
+    order_line_types = load_order_line_types()
+    integ_db.run_multistatement_script(f"""
+    IF OBJECT_ID('tempdb..#OrderLines') IS NOT NULL DROP TABLE #OrderLines;
+    CREATE TABLE #OrderLines (
+        NDC {order_line_types["NDC"][0]} COLLATE DATABASE_DEFAULT,
+        OrderedQty {order_line_types["Quantity"][0]}
+    )
+    """)
+    # Missing values (pd.NA, NaN) cannot be bound by pyodbc; send them as NULL
+    order_lines_df = orders_df[["NDC", "OrderedQty"]].astype(object)
+    order_lines_df = order_lines_df.where(order_lines_df.notna(), None)
+    order_lines = list(order_lines_df.itertuples(index=False, name=None))
+    input_sizes = [order_line_types["NDC"][1], order_line_types["Quantity"][1]]
+    if order_lines:
+        integ_db.execute_many(
+            "INSERT INTO #OrderLines (NDC, OrderedQty) VALUES (?, ?)",
+            order_lines,
+            input_sizes=input_sizes if None not in input_sizes else None
+        )
+
+    comparison_query = """
+    SELECT
+        f.ProductName,
+        COALESCE(f.NDC, o.NDC) AS NDC,
+        COALESCE(f.OrderQty, 0) AS ForecastedOrderQty,
+        COALESCE(o.OrderedQty, 0) AS OrderedQty
+    FROM (
+        SELECT fd.ProductName, fd.NDC, fd.OrderQty
+        FROM [iq].[ForecastDetails] fd
+        JOIN [iq].[ForecastHistory] fh
+            ON fd.ForecastId = fh.Id
+        WHERE fh.CreatedDate >= DATEADD(day, -1, ?)
+          AND fh.CreatedDate < ?
+          AND fh.SiteId = ?
+    ) f
+    FULL OUTER JOIN #OrderLines o
+        ON f.NDC = o.NDC
+    """
+    try:
+        return integ_db.read_sql(
+            comparison_query, (day, day, site_id), input_sizes=DAY_INPUT * 2 + SITE_ID_INPUT
+        )
+    finally:
+        integ_db.run_multistatement_script("DROP TABLE #OrderLines")
+
 # --------------------------
 # 2. User selects site
 # --------------------------
@@ -68,121 +284,88 @@ if selected_site == "":
     st.info("Please select a site to view forecast and orders.")
     st.stop()
 
+# Bound into every dated query and part of every cache key, so the two always agree
+today = date.today()
+
 # --------------------------
 # 3. Get SiteId for the selected site from integration DB
 # --------------------------
-site_query = f"""
-SELECT SiteCode
-FROM contractDW.DimSite
-WHERE PracticeCode = 293
-  AND Name LIKE '%{selected_site}%'
-"""
-site_df = integ_db.read_sql(site_query)
+site_codes = load_site_codes(tuple(site for site in sites if site))
 
-if site_df.empty:
+if selected_site not in site_codes:
     st.error(f"No site found for {selected_site}")
     st.stop()
 
-site_id = site_df.iloc[0]["SiteCode"]
+site_id = site_codes[selected_site]
 
 # --------------------------
 # 4. Fetch Forecast for yesterday (integration DB)
 # --------------------------
-forecast_query = f"""
-SELECT 
-    fd.ProductName,
-    fd.NDC,
-    fd.OrderQty,
-    fd.OrderUOM,
-    fd.ParMin,
-    fd.ParMax,
-    fd.ForecastQty,
-    fd.DispensedQty,
-    fd.PendingTransferQty,
-    fd.PendingOrderedQty,
-    fd.CurrentInventoryQty
-FROM [iq].[ForecastDetails] fd
-JOIN [iq].[ForecastHistory] fh
-    ON fd.ForecastId = fh.Id
-WHERE fh.CreatedDate >= CAST(GETDATE() - 1 AS date)
-  AND fh.CreatedDate < CAST(GETDATE() AS date)
-  AND fh.SiteId = {site_id}
-"""
-forecast_df = integ_db.read_sql(forecast_query)
+# The forecast and the order status/lines do not depend on each other, so both
+# databases are queried at the same time; each worker thread gets its own connection.
+with ThreadPoolExecutor(
+    max_workers=2,
+    initializer=add_script_run_ctx,
+    initargs=(None, get_script_run_ctx())
+) as executor:
+    forecast_future = executor.submit(load_forecast, site_id, today)
+    status_and_orders_future = executor.submit(load_status_and_orders, site_id, today)
+forecast_df = forecast_future.result()
+has_invalid_status, orders_df = status_and_orders_future.result()
 
 # Rename for comparison
 forecast_df = forecast_df.rename(columns={"OrderQty": "ForecastedOrderQty"})
 
 st.subheader("Forecasted Orders (Today's Forecast from Yesterday)")
-st.dataframe(forecast_df, width=1500)
-
-# --------------------------
-# 5. Check OrderStatus (order DB)
-# --------------------------
-status_query = f"""
-SELECT OrderStatusId, PurchaseOrderId
-FROM dbo.PurchaseOrderDetails pod
-WHERE IsLatest = 1
-  AND PurchaseOrderId IN (
-        SELECT id
-        FROM dbo.PurchaseOrders
-        WHERE SiteId = {site_id}
-          AND CreatedDate >= CAST(GETDATE() AS date)
-          AND CreatedDate < DATEADD(day, 1, CAST(GETDATE() AS date))
-  )
-"""
-status_df = order_db.read_sql(status_query)
-
-if any(status_df["OrderStatusId"].isin([1,6])):
+st.dataframe(forecast_df.head(DISPLAY_ROW_LIMIT), width=1500)
+if len(forecast_df) > DISPLAY_ROW_LIMIT:
+    st.caption(f"Showing the first {DISPLAY_ROW_LIMIT:,} forecast rows.")
+
+# --------------------------
+# 5. Check OrderStatus (order DB, fetched alongside the forecast)
+# --------------------------
+if has_invalid_status:
     st.error("One or more orders for this site yesterday have invalid status (1 or 6). Cannot proceed.")
     st.stop()
 
 # --------------------------
-# 6. Fetch actual orders (order DB) with renamed column
+# 6. Actual orders (order DB, fetched with the status check) with renamed column
 # --------------------------
-orders_query = f"""
-SELECT pli.NDC, pli.DrugName, pli.Quantity
-FROM dbo.PoLineItems pli
-WHERE PurchaseOrderId IN (
-    SELECT id
-    FROM dbo.PurchaseOrders
-    WHERE SiteId = {site_id}
-        AND CreatedDate >= CAST(GETDATE() AS date)
-        AND CreatedDate < DATEADD(day, 1, CAST(GETDATE() AS date))
-)
-"""
-orders_df = order_db.read_sql(orders_query)
-
 # Rename quantity column for comparison
 orders_df = orders_df.rename(columns={"Quantity": "OrderedQty"})
 
 st.subheader("Actual Orders (Today's Orders)")
-st.dataframe(orders_df, width=1500)
+st.dataframe(orders_df.head(DISPLAY_ROW_LIMIT), width=1500)
+if len(orders_df) > DISPLAY_ROW_LIMIT:
+    st.caption(f"Showing the first {DISPLAY_ROW_LIMIT:,} of {len(orders_df):,} order lines.")
 
 # --------------------------
-# 7. Simplified Merge for comparison
+# 7. Simplified Merge for comparison (joined on the integration DB server)
 # --------------------------
-comparison_df_simple = pd.merge(
-    forecast_df[["ProductName", "NDC", "ForecastedOrderQty"]],
-    orders_df[["NDC", "OrderedQty"]],
-    on="NDC",
-    how="outer"
-)
-
-# Fill missing quantities with 0
-comparison_df_simple["ForecastedOrderQty"] = comparison_df_simple["ForecastedOrderQty"].fillna(0)
-comparison_df_simple["OrderedQty"] = comparison_df_simple["OrderedQty"].fillna(0)
+# Missing quantities come back as 0
+comparison_df_simple = load_comparison(site_id, today, orders_df)
 
 # --------------------------
 # 8. Conditional highlighting
 # --------------------------
-def highlight_qty(row):
-    if row["ForecastedOrderQty"] == 0 or row["OrderedQty"] == 0:
-        return ['background-color: lightcoral']*len(row)  # Red
-    elif row["ForecastedOrderQty"] == row["OrderedQty"]:
-        return ['background-color: lightgreen']*len(row)  # Green
-    else:
-        return ['background-color: lightyellow']*len(row)  # Yellow
+def highlight_qty(df):
+    # Styles the whole frame at once: one color per row, repeated across columns
+    forecasted = df["ForecastedOrderQty"].to_numpy()
+    ordered = df["OrderedQty"].to_numpy()
+    colors = np.where(
+        (forecasted == 0) | (ordered == 0),
+        'background-color: lightcoral',  # Red
+        np.where(
+            forecasted == ordered,
+            'background-color: lightgreen',  # Green
+            'background-color: lightyellow'  # Yellow
+        )
+    )
+    return pd.DataFrame(
+        np.broadcast_to(colors[:, None], df.shape),
+        index=df.index,
+        columns=df.columns
+    )
 
 st.subheader("Forecast vs Actual Comparison")
-st.dataframe(comparison_df_simple.style.apply(highlight_qty, axis=1), width=1500)
+st.dataframe(comparison_df_simple.style.apply(highlight_qty, axis=None), width=1500)